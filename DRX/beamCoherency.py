@@ -7,27 +7,101 @@ and make sure that the beams agree with the T_NOM values.
 
 import os
 import sys
+import mmap
 import numpy
 
+from scipy.fft import fft, ifft
+
 from lsl.reader import drx
 from lsl.common.dp import fS
 from lsl.astro import unix_to_utcjd, DJD_OFFSET
 
 from matplotlib import pyplot as plt
 
+try:
+    import cupy
+    cupyReady = cupy.cuda.runtime.getDeviceCount() > 0
+except ImportError:
+    cupyReady = False
+except cupy.cuda.runtime.CUDARuntimeError:
+    ## CuPy is installed but there is no usable CUDA device/driver
+    cupyReady = False
+
 
-def crossCorrelate(sig, ref):
+def _unpack_4bit(payload):
+    """
+    Split packed 4-bit DRX samples into separate int8 arrays of I and Q.  I is 
+    stored in the high nibble and Q in the low nibble of each byte; both are 
+    sign extended with an arithmetic right shift.
     """
-    Cross-correlate two signals to get the lag between the two
-    in samples.  Returns a two-element tuple of the lag values 
-    in samples and the strength of the correlation.
+    
+    payload = payload.view(numpy.int8)
+    return payload >> 4, (payload << 4) >> 4
+
+
+def _unpack_drx_block(buf, data, times):
+    """
+    Unpack a block of raw DRX frames read from a file into a (4, nFrames*4096, 2)
+    int8 I/Q `data` array and a (4, nFrames) time tag `times` array, both of 
+    which are indexed by tuning/polarization pair.  Returns the number of 
+    frames unpacked for each pair.
+    """
+    
+    frames = numpy.frombuffer(buf, dtype=numpy.uint8)
+    frames = frames[:frames.size//drx.FRAME_SIZE*drx.FRAME_SIZE].reshape(-1, drx.FRAME_SIZE)
+    
+    # Headers - the tuning/polarization pair comes from the DRX ID and the time 
+    # tag is the first (big endian) word of the payload
+    ids = frames[:,4]
+    pairs = 2*(((ids >> 3) & 7).astype(numpy.int32) - 1) + ((ids >> 7) & 1)
+    timetags = frames[:,16:24].copy().view('>u8')[:,0]
+    
+    # Payloads
+    data = data.reshape(4, -1, 4096, 2)
+    nUnpacked = [0, 0, 0, 0]
+    for pair in range(4):
+        valid = numpy.where(pairs == pair)[0][:times.shape[1]]
+        n = valid.size
+        
+        i, q = _unpack_4bit(frames[valid,32:])
+        data[pair,:n,:,0] = i
+        data[pair,:n,:,1] = q
+        data[pair,n:,:,:] = 0
+        times[pair,:n] = timetags[valid]
+        times[pair,n:] = 0
+        nUnpacked[pair] = n
+        
+    return nUnpacked
+
+
+def crossCorrelate(sigF, refF, window=50):
+    """
+    Cross-correlate two signals, given as their Fourier transforms, to get 
+    the lag between the two in samples.  Returns a four-element tuple of the
+    lag of the correlation peak in samples, the strength of the peak, and the
+    lag values and correlation strengths within `window` samples of the peak.
+    
+    .. note:: If the transforms are CuPy arrays the correlation is done on the
+              GPU and only the peak and the window are copied back.
     """
     
-    cc = numpy.fft.fft(sig)*numpy.fft.fft(ref).conj()
-    cc = numpy.abs(numpy.fft.fftshift(numpy.fft.ifft(cc)))
-    lag = numpy.arange(-len(cc)/2,len(cc)/2)
+    if cupyReady and isinstance(sigF, cupy.ndarray):
+        cc = cupy.abs(cupy.fft.ifft(sigF*refF.conj()))
+        best = int(cupy.argmax(cc))
+    else:
+        cc = numpy.abs(ifft(sigF*refF.conj(), overwrite_x=True, workers=-1))
+        best = numpy.argmax(cc)
+        
+    # Convert the peak location into a lag between -N/2 and N/2-1 and pull out
+    # the region around it
+    nLag = cc.size
+    lag = (best + nLag//2) % nLag - nLag//2
+    lags = numpy.arange(lag-window, lag+window)
     
-    return lag, cc
+    if cupyReady and isinstance(cc, cupy.ndarray):
+        return lag, float(cc[best]), lags, cupy.asnumpy(cc[cupy.asarray(lags % nLag)])
+    else:
+        return lag, cc[best], lags, cc[lags % nLag]
 
 
 def main(args):
@@ -45,13 +119,16 @@ def main(args):
     # Open the various files and get basic data information:  beam, number of 
     # frames per obs, T_NOM, time tag of first frame
     for filename in files:
-        fh.append( open(filename, "rb") )
+        with open(filename, "rb") as rawfh:
+            fh.append( mmap.mmap(rawfh.fileno(), 0, access=mmap.ACCESS_READ) )
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            fh[-1].madvise(mmap.MADV_SEQUENTIAL)
         nFramesFile.append( os.path.getsize(filename) / drx.FRAME_SIZE )
         
         while True:
             junkFrame = drx.read_frame(fh[-1])
             try:
-                srate = junkFrame.sample_rate
+                srate.append( junkFrame.sample_rate )
                 break
             except ZeroDivisionError:
                 pass
@@ -69,21 +146,28 @@ def main(args):
     # Align the files as close as possible by the time tags and then make sure that
     # the first frame processed is from tuning 1, pol 0.
     for i in range(len(files)):
-        junkFrame = drx.read_frame(fh[i])
-        beam, tune, pol = junkFrame.id
-        pair = 2*(tune-1) + pol
+        ## Find the first frame from tuning 1, pol 0.  There are only `beampols`
+        ## frames in a set so this is a short search
         j = 0
-        while junkFrame.payload.timetag < max(tStart):
-            junkFrame = drx.read_frame(fh[i])
-            beam, tune, pol = junkFrame.id
-            pair = 2*(tune-1) + pol
-            j += 1
-        while pair != 0:
+        for k in range(beampols[i]):
             junkFrame = drx.read_frame(fh[i])
             beam, tune, pol = junkFrame.id
             pair = 2*(tune-1) + pol
+            if pair == 0:
+                break
             j += 1
         fh[i].seek(-drx.FRAME_SIZE, 1)
+        t0 = junkFrame.payload.timetag
+        
+        ## Time tags advance by a fixed number of ticks for each set of frames so
+        ## the number of frames to skip from there can be computed directly
+        tickStep = int(round(4096*fS/srate[i]))
+        nSets = max(0, (max(tStart) - t0 + tickStep - 1) // tickStep)
+        fh[i].seek(nSets*beampols[i]*drx.FRAME_SIZE, 1)
+        j += nSets*beampols[i]
+        
+        junkFrame = drx.read_frame(fh[i])
+        fh[i].seek(-drx.FRAME_SIZE, 1)
         print("Shifted beam %i data by %i frames (%.4f s)" % (i, j, j*4096/srate[i]/4))
             
     # Date
@@ -97,21 +181,42 @@ def main(args):
     print("Sample Rate: %s Hz" % ' '.join([str(s) for s in srate]))
     print(" ")
 
-    # Main reader loop - save the data to the `data` list and the raw time tag values
-    # to the `times` list.
+    # Main reader loop - transform each file as it is read and save the raw time 
+    # tag values to the `times` list.  Each signal is only transformed once, 
+    # regardless of how many correlations it appears in.  The data are kept as 
+    # int8 I/Q pairs until they are transformed and only one file is held at a 
+    # time so the raw samples add ~66 MB to the memory needed for the spectra 
+    # (~262 MB per file).  If CuPy is available the spectra are kept on the GPU 
+    # and everything from here on out is done there.
+    #
+    # NOTE:  DRX samples are complex (I/Q) so the full complex transform is 
+    #        needed; a real-input (rfft) transform does not apply here.
     nFrames = 2000
-    data = numpy.zeros((len(files), 4, 4096*nFrames), dtype=numpy.csingle)
+    data = numpy.empty((4, 4096*nFrames, 2), dtype=numpy.int8)
     times = numpy.zeros((len(files), 4, nFrames), dtype=numpy.int64)
+    if cupyReady:
+        print("Using CuPy for the correlations")
+        dataF = cupy.empty((len(files),)+data.shape[:2], dtype=numpy.csingle)
+        vdot = cupy.vdot
+    else:
+        dataF = numpy.empty((len(files),)+data.shape[:2], dtype=numpy.csingle)
+        vdot = numpy.vdot
     for i in range(len(files)):
-        for j in range(nFrames):
-            for k in range(4):
-                frame = drx.read_frame(fh[i])
-                beam, tune, pol = frame.id
-                pair = 2*(tune-1) + pol
-                
-                data[i,pair,j*4096:(j+1)*4096] = frame.payload.data
-                times[i,pair,j] = frame.payload.timetag
-                #print(i, j, k, beam, tune, pol, frame.payload.timetag)
+        ## Work directly from the memory map to avoid copying the frames
+        start = fh[i].tell()
+        stop = min(start + 4*nFrames*drx.FRAME_SIZE, len(fh[i]))
+        _unpack_drx_block(memoryview(fh[i])[start:stop], data, times[i,...])
+        fh[i].seek(stop)
+        
+        ## The conversion to complex64 is done one signal at a time
+        for k in range(4):
+            if cupyReady:
+                sig = cupy.asarray(data[k,:,:]).astype(numpy.float32).view(numpy.csingle)[:,0]
+                dataF[i,k,:] = cupy.fft.fft(sig)
+            else:
+                sig = data[k,:,:].astype(numpy.float32).view(numpy.csingle)[:,0]
+                dataF[i,k,:] = fft(sig, overwrite_x=True, workers=-1)
+    del data
     
     # Cross-correlate
     refs = [0,0,0,0]
@@ -121,13 +226,14 @@ def main(args):
                 fig = plt.figure()
             
             for k in range(4):
-                lag, cc = crossCorrelate(data[j,k,:], data[i,k,:])
-                best = numpy.where( cc == cc.max() )[0][0]
-                
                 if i == j:
-                    refs[k] = cc.max()
+                    ## An autocorrelation always peaks at zero lag so its strength 
+                    ## comes straight from the total power (Parseval's theorem)
+                    refs[k] = float(vdot(dataF[i,k,:], dataF[i,k,:]).real) / dataF.shape[2]
                 else:
-                    ccOffset = lag[best]*fS/srate[i]
+                    lag, peak, lags, cc = crossCorrelate(dataF[j,k,:], dataF[i,k,:])
+                    
+                    ccOffset = lag*fS/srate[i]
                     rtOffset = times[i,k,0] - times[j,k,0]
                     ctOffset = (times[i,k,0] - tnom[i]) - (times[j,k,0] - tnom[j])
                     
@@ -135,7 +241,7 @@ def main(args):
                     print("  T_NOM%i: %i ticks" % (beams[i], tnom[i]))
                     print("  T_NOM%i: %i ticks" % (beams[j], tnom[j]))
                     print("  -> T_NOM%i - T_NOM%i: %i ticks" % (beams[j], beams[i], tnom[j] - tnom[i]))
-                    print("  NCM: %.3f" % (cc.max() / refs[k]))
+                    print("  NCM: %.3f" % (peak / refs[k]))
                     print("  CC Offset: %i ticks" % ccOffset)
                     print("  raw time tag Offset: %i ticks" % rtOffset)
                     print("  cor time tag Offset: %i ticks" % ctOffset)
@@ -143,7 +249,7 @@ def main(args):
                     print("  -> CC - cor: %i ticks" % (ccOffset - ctOffset))
                 
                     ax = fig.add_subplot(2, 2, k+1)     # pylint: disable=possibly-used-before-assignment
-                    ax.plot(lag[best-50:best+50], cc[best-50:best+50])
+                    ax.plot(lags, cc)
                     ax.set_title('Beams %i & %i, Tuning %i, Pol. %i' % (beams[i], beams[j], k/2+1, k%2))
                     ax.set_xlabel('Lag [samples]')
                     ax.set_ylabel('Analysis Sets')
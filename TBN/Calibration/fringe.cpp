@@ -37,6 +37,13 @@ void compute_fringe(long nStand,
 	InType temp, tempRef;
 	Complex64 tempV;
 	
+	// Clip on the squared magnitude to avoid a square root for every sample.  A
+	// clip level of zero means that no excision is done.
+	float clipLevel2 = clipLevel*clipLevel;
+	if( clipLevel <= 0 ) {
+		clipLevel2 = INFINITY;
+	}
+	
 	Py_BEGIN_ALLOW_THREADS
   
 	#ifdef _OPENMP
@@ -63,12 +70,12 @@ void compute_fringe(long nStand,
 				tempRef = *(data + (nSamp*ref + j));
 				
 				// Bad input value
-				if( abs(temp) >= clipLevel ) {
+				if( norm(temp) >= clipLevel2 ) {
 					continue;
 				}
 				
 				// Bad reference input value
-				if( abs(tempRef) >= clipLevel ) {
+				if( norm(tempRef) >= clipLevel2 ) {
 					continue;
 				}
 				
@@ -21,6 +21,7 @@ import tempfile
 
 from hashlib import md5
 from datetime import datetime
+from multiprocessing import Pool
 
 from astropy.constants import c as speedOfLight
 vLight = speedOfLight.to('m/s').value
@@ -57,7 +58,8 @@ def md5sum(ssmifContents):
 def getGeoDelay(antenna1, antenna2, az, el, Degrees=False):
     """
     Get the geometrical delay (relative to a second antenna) for the 
-    specified antenna for a source at azimuth az, elevation el.
+    specified antenna for a source at azimuth az, elevation el.  az and el
+    can also be arrays, in which case an array of delays is returned.
     """
     
     if Degrees:
@@ -72,7 +74,7 @@ def getGeoDelay(antenna1, antenna2, az, el, Degrees=False):
     xyz2 = numpy.array([antenna2.stand.x, antenna2.stand.y, antenna2.stand.z])
     xyzRel = xyz1 - xyz2
     
-    return numpy.dot(source, xyzRel) / vLight
+    return numpy.dot(xyzRel, source) / vLight
 
 
 def getFringeRate(antenna1, antenna2, observer, src, freq):
@@ -88,11 +90,61 @@ def getFringeRate(antenna1, antenna2, observer, src, freq):
     HA = (float(observer.sidereal_time()) - float(src.ra))*12.0/numpy.pi
     dec = float(src.dec)*180/numpy.pi
     
+    return getFringeRateHADec(antenna1, antenna2, HA, dec, freq)
+
+
+def getFringeRateHADec(antenna1, antenna2, HA, dec, freq):
+    """
+    Get the fringe rate for a baseline formed by antenna1-antenna2 for a 
+    source at hour angle HA (in hours) and declination dec (in degrees).
+    """
+    
     # Get the u,v,w coordinates
     uvw = compute_uvw([antenna1, antenna2], HA=HA, dec=dec, freq=freq)
     #print(uvw[0,0,0])
     
-    return -(2*numpy.pi/86164.0905)*uvw[0,0,0]*numpy.cos(src.dec)
+    return -(2*numpy.pi/86164.0905)*uvw[0,0,0]*numpy.cos(dec*numpy.pi/180)
+
+
+def fringeStop(data, times, freq, HA, dec, az, el, antennas, refX, refY):
+    """
+    Fringe stop on a source and remove the array geometry from a (time, input)
+    set of visibilities at a single frequency.  The position of the source at
+    each time is given by its hour angle (in hours), declination (in degrees),
+    azimuth, and elevation (in radians).  Returns the corrected visibilities.
+    """
+    
+    fRate = numpy.zeros(data.shape, dtype=numpy.float64)
+    gDelay = numpy.zeros(data.shape, dtype=numpy.float64)
+    for j in range(data.shape[1]):
+        if j % 2 == 0:
+            refAnt = antennas[refX]
+        else:
+            refAnt = antennas[refY]
+            
+        # Compute the fringe rates across all time
+        for k in range(data.shape[0]):
+            fRate[k,j] = getFringeRateHADec(antennas[j], refAnt, HA[k], dec[k], freq)
+            
+        # Calculate the geometric delay term across all time
+        gDelay[:,j] = getGeoDelay(antennas[j], refAnt, az, el, Degrees=False)
+        
+    # Fringe stop to more the source of interest to the DC component and remove
+    # the array geometry for all inputs at once.  The phase is built up in place
+    # and the rotation is computed at the precision of the data so that there is
+    # no upcast to complex128.
+    phase = fRate
+    phase *= (times - times[0])[:,None]
+    gDelay *= freq
+    phase += gDelay
+    phase *= -2*numpy.pi
+    
+    rot = numpy.empty(data.shape, dtype=data.dtype)
+    numpy.cos(phase, out=rot.real)
+    numpy.sin(phase, out=rot.imag)
+    data *= rot
+    
+    return data
 
 
 def main(args):
@@ -208,14 +260,12 @@ def main(args):
         
         if nTimes < maxTime:
             ## Pad 'time'
-            newTime = numpy.zeros(maxTime, dtype=time[i].dtype)
-            newTime += numpy.nan
+            newTime = numpy.full(maxTime, numpy.nan, dtype=time[i].dtype)
             newTime[0:nTimes] = time[i][:]
             time[i] = newTime
             
             ## Pad 'data'
-            newData = numpy.zeros((maxTime, data[i].shape[1]), dtype=data[i].dtype)
-            newData += numpy.nan
+            newData = numpy.full((maxTime, data[i].shape[1]), numpy.nan, dtype=data[i].dtype)
             newData[0:nTimes,:] = data[i][:,:]
             data[i] = newData
             
@@ -273,72 +323,51 @@ def main(args):
     # Compute source positions/fringe stop and remove the source
     #
     print("Fringe stopping on '%s':" % refSrc.name)
-    pbar = ProgressBar(max=freq.size*520)
+    pbar = ProgressBar(max=freq.size)
     
+    ## Each frequency is independent so they are processed in parallel once the
+    ## source positions are known
+    taskPool = Pool()
+    taskList = []
     for i in range(freq.size):
         fq = freq[i]
         
-        for j in range(data.shape[2]):
-            # Compute the times in seconds relative to the beginning
-            times  = time[i,:] - time[i,0]
-            times *= 24.0
-            times *= 3600.0
-            
-            # Compute the fringe rates across all time
-            fRate = [None,]*data.shape[1]
-            for k in range(data.shape[1]):
-                jd = time[i,k]
-                
-                try:
-                    currDate = datetime.utcfromtimestamp(utcjd_to_unix(jd))
-                except ValueError:
-                    pass
-                observer.date = currDate.strftime("%Y/%m/%d %H:%M:%S")
-                refSrc.compute(observer)
-        
-                if j % 2 == 0:
-                    fRate[k] = getFringeRate(antennas[j], antennas[refX], observer, refSrc, fq)
-                else:
-                    fRate[k] = getFringeRate(antennas[j], antennas[refY], observer, refSrc, fq)
-                    
-            # Create the basis rate and the residual rates
-            baseRate = fRate[0]
-            residRate = numpy.array(fRate) - baseRate
+        # Compute the times in seconds relative to the beginning
+        times  = time[i,:] - time[i,0]
+        times *= 24.0
+        times *= 3600.0
         
-            # Fringe stop to more the source of interest to the DC component
-            data[i,:,j] *= numpy.exp(-2j*numpy.pi* baseRate*(times - times[0]))
-            data[i,:,j] *= numpy.exp(-2j*numpy.pi*residRate*(times - times[0]))
+        # Compute the position of the source across all time.  This only depends
+        # on the time so it is shared by all of the inputs.
+        HA  = numpy.zeros(data.shape[1], dtype=numpy.float64)
+        dec = numpy.zeros(data.shape[1], dtype=numpy.float64)
+        az  = numpy.zeros(data.shape[1], dtype=numpy.float64)
+        el  = numpy.zeros(data.shape[1], dtype=numpy.float64)
+        for k in range(data.shape[1]):
+            jd = time[i,k]
             
-            # Calculate the geometric delay term across all time
-            gDelay = [None,]*data.shape[1]
-            for k in range(data.shape[1]):
-                jd = time[i,k]
-                
-                try:
-                    currDate = datetime.utcfromtimestamp(utcjd_to_unix(jd))
-                except ValueError:
-                    pass
-                observer.date = currDate.strftime("%Y/%m/%d %H:%M:%S")
-                refSrc.compute(observer)
-                
-                az = refSrc.az
-                el = refSrc.alt
-                if j % 2 == 0:
-                    gDelay[k] = getGeoDelay(antennas[j], antennas[refX], az, el, Degrees=False)
-                else:
-                    gDelay[k] = getGeoDelay(antennas[j], antennas[refY], az, el, Degrees=False)
-                    
-            # Create the basis delay and the residual delays
-            baseDelay = gDelay[0]
-            residDelay = numpy.array(gDelay) - baseDelay
+            try:
+                currDate = datetime.utcfromtimestamp(utcjd_to_unix(jd))
+            except ValueError:
+                pass
+            observer.date = currDate.strftime("%Y/%m/%d %H:%M:%S")
+            refSrc.compute(observer)
             
-            # Remove the array geometry
-            data[i,:,j] *= numpy.exp(-2j*numpy.pi*fq* baseDelay)
-            data[i,:,j] *= numpy.exp(-2j*numpy.pi*fq*residDelay)
+            HA[k] = (float(observer.sidereal_time()) - float(refSrc.ra))*12.0/numpy.pi
+            dec[k] = float(refSrc.dec)*180/numpy.pi
+            az[k] = refSrc.az
+            el[k] = refSrc.alt
             
-            pbar.inc()
-            sys.stdout.write("%s\r" % pbar.show())
-            sys.stdout.flush()
+        taskList.append( (i,taskPool.apply_async(fringeStop, args=(data[i,:,:], times, fq, HA, dec, az, el, antennas, refX, refY))) )
+    taskPool.close()
+    
+    for i,task in taskList:
+        data[i,:,:] = task.get()
+        
+        pbar.inc()
+        sys.stdout.write("%s\r" % pbar.show())
+        sys.stdout.flush()
+    taskPool.join()
     sys.stdout.write('\n')
     
     # Average down to remove other sources/the correlated sky
@@ -348,11 +377,10 @@ def main(args):
     time = time[:,0]
     
     data2 = numpy.zeros((data.shape[0], data.shape[2]), dtype=data.dtype)
-    for j in range(data2.shape[1]):
-        for fStart in ls.keys():
-            l = ls[fStart]
-            m = ms[fStart]
-            data2[l,j] = data[l,:m,j].mean(axis=1)
+    for fStart in ls.keys():
+        l = ls[fStart]
+        m = ms[fStart]
+        data2[l,:] = data[l,:m,:].mean(axis=1)
     data = data2
     print("Output (post-averaging) data shapes:")
     print("  time:", time.shape)
@@ -13,22 +13,20 @@ Usage:
 
 import os
 import sys
+import mmap
 import ephem
 import numpy
 import argparse
 
 from lsl.common.stations import lwa1, parse_ssmif
+from lsl.common.dp import fS
 from lsl.reader import tbn
-from lsl.reader import errors
-from lsl.reader.buffer import TBNFrameBuffer
 from lsl.astro import unix_to_utcjd, DJD_OFFSET
 from lsl.common.data_access import DataAccess
 from lsl.misc import parser as aph
 
 from matplotlib import pyplot as plt
 
-from collections import deque
-
 import fringe
 
 
@@ -42,17 +40,56 @@ _srcs = ["ForA,f|J,03:22:41.70,-37:12:30.0,1",
          "CasA,f|J,23:23:27.94,+58:48:42.4,1",]
 
 
-def unitRead(fh, count=520, found={}):
-    for i in range(count):
-        frame = tbn.read_frame(fh)
-        
-        try:
-            found[frame.payload.timetag].append(frame)
-        except KeyError:
-            found[frame.payload.timetag] = []
-            found[frame.payload.timetag].append(frame)
+def _read_tbn_block(fh, count):
+    """
+    Read a block of `count` raw TBN frames from a memory mapped file and parse 
+    them.  Reading stops at the end of the file or at the first frame that 
+    does not have a valid sync word.  Returns a four-element tuple of the 
+    input index (2*(stand-1)+pol), time tag, tuning word, and interleaved
+    int8 I/Q data for each frame read.
+    
+    .. note:: The I/Q data are a view into the memory map and must be 
+              released before the map is closed.
+    """
+    
+    start = fh.tell()
+    count = min(count, (len(fh) - start) // tbn.FRAME_SIZE)
+    frames = numpy.frombuffer(fh, dtype=numpy.uint8, count=count*tbn.FRAME_SIZE, offset=start)
+    frames = frames.reshape(-1, tbn.FRAME_SIZE)
+    fh.seek(start + count*tbn.FRAME_SIZE)
+    
+    # Trim at the first Mark 5C sync error
+    syncs = frames[:,0:4].copy().view('>u4')[:,0]
+    bad = numpy.where(syncs != 0x5CDEC0DE)[0]
+    if bad.size > 0:
+        frames = frames[:bad[0],:]
         
-    return found
+    # Headers - in the current configuration, stands start at 1 and go up to 260
+    # so the input index is one less than the lower ten bits of the TBN ID
+    tuningWords = frames[:,8:12].copy().view('>u4')[:,0]
+    aStands = (frames[:,12:14].copy().view('>u2')[:,0] & 1023).astype(numpy.int32) - 1
+    timetags = frames[:,16:24].copy().view('>i8')[:,0]
+    
+    # Payloads - 8-bit I/Q
+    payloads = frames[:,24:].view(numpy.int8)
+    
+    return aStands, timetags, tuningWords, payloads
+
+
+def unitRead(fh, count=520):
+    """
+    Read in `count` TBN frames from a memory mapped file and group them by 
+    time tag.  Returns a four-element tuple of the unique time tags, the 
+    number of frames found for each time tag, and the input indices and 
+    complex64 data for the frames sorted by time tag.
+    """
+    
+    aStands, timetags, _, payloads = _read_tbn_block(fh, count)
+    
+    order = numpy.argsort(timetags, kind='stable')
+    timetags, counts = numpy.unique(timetags[order], return_counts=True)
+    
+    return timetags, counts, aStands[order], payloads[order,:].astype(numpy.float32).view(numpy.complex64)
 
 
 def main(args):
@@ -71,7 +108,10 @@ def main(args):
     antennas = site.antennas
     
     # The file's parameters
-    fh = open(filename, 'rb')
+    with open(filename, 'rb') as rawfh:
+        fh = mmap.mmap(rawfh.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        fh.madvise(mmap.MADV_SEQUENTIAL)
     
     nFramesFile = os.path.getsize(filename) // tbn.FRAME_SIZE
     srate = tbn.get_sample_rate(fh)
@@ -113,7 +153,6 @@ def main(args):
     try:
         central_freq = junkFrame.central_freq
     except AttributeError:
-        from lsl.common.dp import fS
         central_freq = fS * junkFrame.header.second_count / 2**32
     beginDate = junkFrame.time.datetime
     
@@ -139,8 +178,18 @@ def main(args):
     print("Integration: %.3f s (%i frames; %i frames per stand/pol)" % (tInt, nFrames, nFrames // antpols))
     print("Chunks: %i" % nChunks)
     
-    # Create the FrameBuffer instance
-    buffer = TBNFrameBuffer(stands=range(1,antpols//2+1), pols=[0, 1])
+    # Align on the start of the first complete set of frames.  All of the frames
+    # in a set share a time tag so a change in the time tag within the first 
+    # `antpols` frames means that the file starts part way through a set.
+    start = fh.tell()
+    timetags = _read_tbn_block(fh, antpols)[1]
+    edges = numpy.where(numpy.diff(timetags) != 0)[0] + 1
+    if edges.size > 0:
+        start += edges[0]*tbn.FRAME_SIZE
+        startTag = timetags[edges[0]]
+    else:
+        startTag = timetags[0]
+    fh.seek(start)
     
     # Create the phase average and times
     LFFT = 512
@@ -148,83 +197,113 @@ def main(args):
     simpleVis = numpy.zeros((nChunks, antpols), dtype=numpy.complex64)
     central_freqs = numpy.zeros(nChunks, dtype=numpy.float64)
     
+    # Create the data array once and reuse it for every chunk.  This is stored as 
+    # (input, frame, sample) so that each frame can be placed with a single store.
+    # The I/Q samples are written through a float32 view of this array so that 
+    # they are converted from int8 as they are stored.
+    dataBuffer = numpy.zeros((antpols, nFrames//antpols, 512), dtype=numpy.complex64)
+    dataBufferIQ = dataBuffer.view(numpy.float32)
+    filledBuffer = numpy.zeros((antpols, nFrames//antpols), dtype=bool)
+    
+    # Frames are placed by time tag so that dropped frames do not shift the 
+    # inputs relative to one another
+    tickStep = int(round(512*fS/srate))
+    nextTag = startTag
+    
     # Go!
-    k = 0
-    for i in range(nChunks):
+    i = 0
+    k = start // tbn.FRAME_SIZE
+    while i < nChunks:
         # Find out how many frames remain in the file.  If this number is larger
         # than the maximum of frames we can work with at a time (maxFrames),
         # only deal with that chunk
         framesRemaining = nFramesFile - k
         if framesRemaining > nFrames:
             framesWork = nFrames
-            data = numpy.zeros((antpols, framesWork//antpols*512), dtype=numpy.complex64)
         else:
-            framesWork = framesRemaining + antpols*buffer.nsegments
-            data = numpy.zeros((antpols, framesWork//antpols*512), dtype=numpy.complex64)
+            framesWork = framesRemaining
+        fillsWork = framesWork // antpols
+        data3d = dataBuffer[:, :fillsWork, :]
+        data3dIQ = dataBufferIQ[:, :fillsWork, :]
+        filled = filledBuffer[:, :fillsWork]
+        filled[...] = False
+        
+        # Start the chunk where the last one left off unless the time tags jump
+        # ahead, i.e., at a gap between captures
+        pos = fh.tell()
+        firstTag = _read_tbn_block(fh, 1)[1]
+        fh.seek(pos)
+        if firstTag.size == 0:
+            ## Exit at the EOF or the first sync error
+            break
+        chunkTag0 = max(nextTag, firstTag[0])
+        nextTag = chunkTag0 + (nFrames//antpols)*tickStep
         print("Working on chunk %i, %i frames remaining" % (i+1, framesRemaining))
         
-        count = [0 for a in range(len(antennas))]
+        # Save the time
+        times[i] = chunkTag0 / fS
         
         j = 0
-        fillsWork = framesWork // antpols
         # Inner loop that actually reads the frames into the data array
         done = False
-        while j < fillsWork:
-            cFrames = deque()
-            for l in range(len(antennas)):
-                try:
-                    cFrames.append( tbn.read_frame(fh) )
-                    k = k + 1
-                except errors.EOFError:
-                    ## Exit at the EOF
-                    done = True
-                    break
-                except errors.SyncError:
-                    #print("WARNING: Mark 5C sync error on frame #%i" % (int(fh.tell())/tbn.FRAME_SIZE-1))
-                    ## Exit at the first sync error
-                    done = True
-                    break
-                    
-            buffer.append(cFrames)
-            cFrames = buffer.get()
-
-            if cFrames is None:
-                continue
+        while True:
+            pos = fh.tell()
+            aStands, timetags, tuningWords, payloads = _read_tbn_block(fh, antpols)
+            if aStands.size < antpols:
+                ## Exit at the EOF or the first sync error
+                done = True
                 
-            for cFrame in cFrames:
-                stand,pol = cFrame.header.id
-                
-                # In the current configuration, stands start at 1 and go up to 260.  So, we
-                # can use this little trick to populate the data array
-                aStand = 2*(stand-1)+pol
-                
-                # Save the time
-                if j == 0 and aStand == 0:
-                    times[i] = cFrame.time
-                    try:
-                        central_freqs[i] = cFrame.central_freq
-                    except AttributeError:
-                        central_freqs[i] = fS * cFrame.header.second_count / 2**32
-                    if i > 0:
-                        if central_freqs[i] != central_freqs[i-1]:
-                            print("Frequency change from %.3f to %.3f MHz at chunk %i" % (central_freqs[i-1]/1e6, central_freqs[i]/1e6, i+1))
-                
-                data[aStand, count[aStand]*512:(count[aStand]+1)*512] = cFrame.payload.data
+            # Figure out where each frame goes
+            slots = (timetags - chunkTag0) // tickStep
+            
+            ## Stop at the first frame that belongs to the next chunk and leave it
+            ## for the next time through
+            late = numpy.where(slots >= fillsWork)[0]
+            if late.size > 0:
+                fh.seek(pos + late[0]*tbn.FRAME_SIZE)
+                aStands, slots, tuningWords, payloads = aStands[:late[0]], slots[:late[0]], tuningWords[:late[0]], payloads[:late[0],:]
+                done = False
                 
-                # Update the counters so that we can average properly later on
-                count[aStand] = count[aStand] + 1
+            # Save the frequency
+            if j == 0 and aStands.size > 0:
+                central_freqs[i] = fS * tuningWords[0] / 2**32
+                if i > 0:
+                    if central_freqs[i] != central_freqs[i-1]:
+                        print("Frequency change from %.3f to %.3f MHz at chunk %i" % (central_freqs[i-1]/1e6, central_freqs[i]/1e6, i+1))
+                        
+            ## Skip frames from unknown inputs and from before the chunk
+            valid = numpy.where((aStands >= 0) & (aStands < antpols) & (slots >= 0))[0]
+            data3dIQ[aStands[valid], slots[valid], :] = payloads[valid,:]
+            
+            # Keep track of what was filled so that the rest can be cleared
+            filled[aStands[valid], slots[valid]] = True
             
             j += 1
             
-            if done:
+            if done or late.size > 0:
                 break
+        k = fh.tell() // tbn.FRAME_SIZE
 
+        ## Release the view into the memory map
+        del payloads
+        
         if done:
             break
+            
+        ## Nothing landed in this chunk so it does not count against the total
+        if not filled.any():
+            continue
+            
+        # Clear out any samples left over from the previous chunk for frames
+        # that were dropped
+        data3d[~filled] = 0
+        data = data3d.reshape(antpols, -1)
         
         # Time-domain blanking and cross-correlation with the outlier
         simpleVis[i,:] = fringe.Simple(data, refX, refY, args.clip)     # pylint: disable=used-before-assignment, possibly-used-before-assignment
-    
+        
+        i += 1
+        
     fh.close()
     
     # Save the data
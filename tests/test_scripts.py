@@ -9,6 +9,8 @@ import sys
 import os
 import json
 
+from concurrent.futures import ProcessPoolExecutor
+
 currentDir = os.path.abspath(os.getcwd())
 if os.path.exists(os.path.join(currentDir, 'test_scripts.py')):
     MODULE_BUILD = currentDir
@@ -23,12 +25,6 @@ try:
     if MODULE_BUILD is not None:
         run_scripts_tests = True
         
-        # Pre-seed TBF/Calibration/analysis.py
-        os.system("%s ../TBF/Calibration/analysis.py" % sys.executable)
-        
-        # Pre-seed TBN/data.py
-        os.system("%s ../TBN/data.py" % sys.executable)
-        
 except ImportError:
     pass
 
@@ -47,10 +43,35 @@ _PYLINT_IGNORES = [('no-member',              "Module 'wx' has no"),
                    ('bad-string-format-type', "Argument '.ndarray' does not match format")]
 
 
+def _run_pylint(script):
+    """
+    Run pylint on a single script and return the parsed JSON results.  This
+    is a module-level function so that it can be run in a worker process.
+    """
+    
+    pylint_output = StringIO()
+    reporter = JSONReporter(pylint_output)
+    Run([script, '-E', '--extension-pkg-allow-list=scipy.special,lsl.correlator._core'], reporter=reporter, exit=False)
+    return json.loads(pylint_output.getvalue())
+
+
 @unittest.skipUnless(run_scripts_tests, "requires the 'pylint' module")
 class scripts_tests(unittest.TestCase):
     """A unittest.TestCase collection of unit tests for the commissioning scripts."""
     
+    @classmethod
+    def setUpClass(cls):
+        """Pre-seed the scripts that generate files needed by other scripts."""
+        
+        # NOTE:  This is done here rather than at import so that it is not 
+        #        repeated by the pylint worker processes
+        
+        # Pre-seed TBF/Calibration/analysis.py
+        os.system("%s ../TBF/Calibration/analysis.py" % sys.executable)
+        
+        # Pre-seed TBN/data.py
+        os.system("%s ../TBN/data.py" % sys.executable)
+        
     @staticmethod
     def _name_to_name(filename):
         filename = os.path.splitext(filename)[0]
@@ -71,14 +92,14 @@ class scripts_tests(unittest.TestCase):
         _SCRIPTS = list(filter(lambda x: x.find('test_scripts.py') == -1, _SCRIPTS))
         _SCRIPTS = list(filter(lambda x: x.find('setup.py') == -1, _SCRIPTS))
         _SCRIPTS.sort()
-        for script in _SCRIPTS:
+        
+        # Run pylint on all of the scripts in parallel and then check the results
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            all_results = list(executor.map(_run_pylint, _SCRIPTS))
+            
+        for script,results in zip(_SCRIPTS, all_results):
             name = self._name_to_name(script)
             with self.subTest(script=name):
-                pylint_output = StringIO()
-                reporter = JSONReporter(pylint_output)
-                Run([script, '-E', '--extension-pkg-allow-list=scipy.special,lsl.correlator._core'], reporter=reporter, exit=False)
-                results = json.loads(pylint_output.getvalue())
-                
                 for i,entry in enumerate(results):
                     with self.subTest(error_number=i+1):
                         false_positive = False